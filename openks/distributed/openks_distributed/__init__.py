@@ -1,11 +1,23 @@
 # Copyright (c) 2021 OpenKS Authors, DCD Research Lab, Zhejiang University. 
 # All Rights Reserved.
 
-from .gpu import algorithm as heterogeneous_algorithm
-from .cpu import algorithm as general_algorithm
+# the cpu and gpu algorithms import paddle, which is slow, so they are only
+# imported once one of them is asked for
+
+def __getattr__(name):
+    if name == "heterogeneous_algorithm":
+        from .gpu import algorithm
+        return algorithm
+    if name == "general_algorithm":
+        from .cpu import algorithm
+        return algorithm
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 class KSDistributedFactory:
     @staticmethod
     def instantiation(flag):
-        return heterogeneous_algorithm if flag else general_algorithm
-
+        if flag:
+            from .gpu import algorithm
+        else:
+            from .cpu import algorithm
+        return algorithm
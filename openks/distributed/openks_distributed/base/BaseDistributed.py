@@ -5,19 +5,32 @@
 from __future__ import print_function
 
 import abc
+import concurrent.futures
+import os
 
-import paddle.fluid as fluid
-from paddle.fluid.executor import Executor
-from paddle.fluid.optimizer import SGD
-from paddle.fluid.contrib.mixed_precision.decorator import OptimizerWithMixedPrecision
+import numpy as np
 
-from ...openks_distributed.base.RoleMaker import MPISymetricRoleMaker, RoleMakerBase, UserDefinedRoleMaker
+from ...openks_distributed.base.RoleMaker import MPIRoleMaker, MPISymetricRoleMaker, RoleMakerBase, UserDefinedRoleMaker
 from ...openks_distributed.base import mode
 from ...openks_distributed.base.mode import Mode
 
 __all__ = ['BaseDistributedAlgorithm', 'BaseDistributedOptimizer']
 __all__ += mode.__all__
 
+# paddle is slow to import, so it is only imported once it is really needed
+_lazy = {}
+
+
+def _lazy_import(name):
+    if not _lazy:
+        import paddle.fluid as fluid
+        from paddle.fluid.executor import Executor
+        from paddle.fluid.optimizer import SGD
+        from paddle.fluid.contrib.mixed_precision.decorator import OptimizerWithMixedPrecision
+        _lazy.update(fluid=fluid, Executor=Executor, SGD=SGD,
+                     OptimizerWithMixedPrecision=OptimizerWithMixedPrecision)
+    return _lazy[name]
+
 
 class BaseDistributedAlgorithm(object):
     """
@@ -37,6 +50,26 @@ class BaseDistributedAlgorithm(object):
         self._optimizer = None
         self._role_maker = None
         self._executor = None
+        self._executor_is_server = None
+        self._cpu_group = None
+        self._barrier_counter = 0
+        self._barrier_every = int(os.environ.get("OPENKS_BARRIER_EVERY", "1"))
+        if self._barrier_every < 1:
+            raise ValueError("OPENKS_BARRIER_EVERY must be a positive integer")
+        # dtype -> [(input, output)] waiting to be reduced in one fused call
+        self._reduce_buf = {}
+        self._reduce_bytes = 0
+        self._fusion_threshold = int(
+            os.environ.get("OPENKS_FUSION_THRESHOLD", "0"))
+        self._short_msg_bytes = int(
+            os.environ.get("OPENKS_ALLREDUCE_SHORT_MSG", str(16 * 1024)))
+        self._pipeline_threshold = int(
+            os.environ.get("OPENKS_PIPELINE_THRESHOLD", str(4 * 1024 * 1024)))
+        self._async_collective = \
+            os.environ.get("OPENKS_ASYNC_COLLECTIVE", "0") == "1"
+        self._collective_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1)
+        self._collective_futures = []
 
     def is_first_worker(self):
         """
@@ -84,10 +117,10 @@ class BaseDistributedAlgorithm(object):
             list/string: server endpoints
         """
 
+        endpoints = self._get_trainer_endpoints()
         if to_string:
-            return ",".join(self._role_maker.get_trainer_endpoints())
-        else:
-            return self._role_maker.get_trainer_endpoints()
+            return ",".join(endpoints)
+        return endpoints
 
     def server_num(self):
         """
@@ -96,7 +129,7 @@ class BaseDistributedAlgorithm(object):
         Returns:
             int: server number
         """
-        return len(self._role_maker.get_pserver_endpoints())
+        return len(self._get_pserver_endpoints())
 
     def server_index(self):
         """
@@ -115,10 +148,10 @@ class BaseDistributedAlgorithm(object):
             list/string: server endpoints
         """
 
+        endpoints = self._get_pserver_endpoints()
         if to_string:
-            return ",".join(self._role_maker.get_pserver_endpoints())
-        else:
-            return self._role_maker.get_pserver_endpoints()
+            return ",".join(endpoints)
+        return endpoints
 
     def is_server(self):
         """
@@ -130,6 +163,12 @@ class BaseDistributedAlgorithm(object):
         """
         return self._role_maker.is_server()
 
+    def _get_trainer_endpoints(self):
+        return self._role_maker.get_trainer_endpoints()
+
+    def _get_pserver_endpoints(self):
+        return self._role_maker.get_pserver_endpoints()
+
     def split_files(self, files):
         """
         split files before distributed training,
@@ -147,23 +186,15 @@ class BaseDistributedAlgorithm(object):
         if not isinstance(files, list):
             raise TypeError("files should be a list of file need to be read.")
 
-        trainer_id = self.worker_index()
-        trainers = self.worker_num()
-
-        remainder = len(files) % trainers
-        blocksize = len(files) / trainers
-
-        blocks = [blocksize] * trainers
-        for i in range(remainder):
-            blocks[i] += 1
+        # MPISymetricRoleMaker reports both as floats
+        trainer_id = int(self.worker_index())
+        trainers = int(self.worker_num())
 
-        trainer_files = [[]] * trainers
-        begin = 0
-        for i in range(trainers):
-            trainer_files[i] = files[begin:begin + blocks[i]]
-            begin += blocks[i]
+        blocksize, remainder = divmod(len(files), trainers)
+        begin = trainer_id * blocksize + min(trainer_id, remainder)
+        end = begin + blocksize + (1 if trainer_id < remainder else 0)
 
-        return trainer_files[trainer_id]
+        return files[begin:end]
 
     def init(self, role_maker=None):
         """
@@ -177,29 +208,233 @@ class BaseDistributedAlgorithm(object):
         Returns:
             None
         """
-        self._executor = Executor(fluid.CPUPlace())
-
         if role_maker and not isinstance(role_maker, RoleMakerBase):
             raise TypeError("role_maker must be an instance of RoleMakerBase")
         self._role_maker = role_maker
         self._role_maker.generate_role()
+
+        # kept across re-init, e.g. after an elastic restart, unless it was
+        # closed by stop_worker() or the role and so the place changed
+        is_server = self._role_maker.is_server()
+        if self._executor is None \
+                or getattr(self._executor, "_closed", False) \
+                or self._executor_is_server != is_server:
+            fluid = _lazy_import("fluid")
+            if fluid.is_compiled_with_cuda() \
+                    and fluid.core.get_cuda_device_count() > 0 \
+                    and not is_server:
+                gpus = os.environ.get("FLAGS_selected_gpus", "0")
+                place = fluid.CUDAPlace(int(gpus.split(",")[0]))
+            else:
+                place = fluid.CPUPlace()
+            self._executor = _lazy_import("Executor")(place)
+            self._executor_is_server = is_server
+
+        # bind the role maker's accessors once, they are queried every step
+        rm = self._role_maker
+        self.is_first_worker = rm.is_first_worker
+        self.worker_index = rm.worker_index
+        self.worker_num = rm.worker_num
+        self.is_worker = rm.is_worker
+        self.is_server = rm.is_server
+        self.server_index = rm.server_index
+        self._get_trainer_endpoints = rm.get_trainer_endpoints
+        self._get_pserver_endpoints = rm.get_pserver_endpoints
+
+        # role makers backed by a torch ProcessGroup (e.g. NCCL) would sync the
+        # device stream on every barrier, so barriers go through a gloo group
+        # of the workers. new_group must be called by every process.
+        if rm.get_process_group() is not None:
+            import torch.distributed as dist
+            group = dist.new_group(ranks=rm.get_worker_ranks(), backend="gloo")
+            if rm.is_worker():
+                self._cpu_group = group
+
+        # the background collective thread and the caller may both call MPI
+        if self._async_collective and isinstance(rm, MPIRoleMaker) \
+                and rm.MPI.Query_thread() != rm.MPI.THREAD_MULTIPLE:
+            raise RuntimeError(
+                "OPENKS_ASYNC_COLLECTIVE=1 needs MPI initialized with "
+                "MPI.THREAD_MULTIPLE")
+
         self._is_initialized = True
 
-    def all_reduce_worker(self, input, output):
+    def all_reduce_worker(self, input, output, algo="auto"):
         """
         all reduce between workers, only support array of one dim.
 
+        If OPENKS_FUSION_THRESHOLD (bytes) is set, small arrays are buffered
+        and reduced together once the pending size crosses the threshold, so
+        `output` is only filled after that or after flush_all_reduce().
+        `input` is copied when buffered and may be reused right away.
+
+        If OPENKS_ASYNC_COLLECTIVE=1, the reduction runs on a background
+        thread and the call returns at once, call wait_all_reduce() before
+        reading `output`. `input` is copied before returning and may be
+        reused right away. Under MPI this needs MPI.THREAD_MULTIPLE.
+
         Args:
             input(list|numpy.array): array of one dim
             output(list|numpy.array): array of one dim
-        """
-        self._role_maker.all_reduce_worker(input, output)
+            algo(str): "auto", "recursive_doubling" or "rs_ag".
+                "recursive_doubling" is the role maker's plain all reduce,
+                a single MPI Allreduce for MPI role makers. "auto" uses it
+                for arrays shorter than OPENKS_ALLREDUCE_SHORT_MSG bytes,
+                reduce-scatter + allgather otherwise, and arrays above
+                OPENKS_PIPELINE_THRESHOLD bytes with a numpy output are
+                reduced as pipelined chunks. An explicit algo skips the
+                pipelining. Fused arrays always use "auto".
+
+        Returns:
+            concurrent.futures.Future: only with OPENKS_ASYNC_COLLECTIVE=1
+        """
+        if algo not in ("auto", "recursive_doubling", "rs_ag"):
+            raise ValueError("unknown algo: %s" % algo)
+        if not self._async_collective:
+            self._sync_all_reduce_worker(input, output, algo)
+            return None
+
+        future = self._collective_pool.submit(self._sync_all_reduce_worker,
+                                              np.array(input, copy=True),
+                                              output, algo, False)
+        self._collective_futures.append(future)
+        return future
+
+    def wait_all_reduce(self):
+        """
+        wait for all reductions submitted by all_reduce_worker on the
+        background thread, re-raising their errors.
+        """
+        futures, self._collective_futures = self._collective_futures, []
+        for future in futures:
+            future.result()
+
+    def _sync_all_reduce_worker(self, input, output, algo="auto", copy=True):
+        if self._fusion_threshold <= 0:
+            self._all_reduce(input, output, algo)
+            return
+
+        input = np.array(input, copy=copy)
+        self._reduce_buf.setdefault(input.dtype, []).append((input, output))
+        self._reduce_bytes += input.nbytes
+        if self._reduce_bytes >= self._fusion_threshold:
+            self._flush_all_reduce()
+
+    def flush_all_reduce(self):
+        """
+        reduce all buffered arrays of all_reduce_worker, one call per dtype.
+        Should be called at least at the end of every epoch.
+        """
+        self.wait_all_reduce()
+        self._flush_all_reduce()
+
+    def _flush_all_reduce(self):
+        for pending in self._reduce_buf.values():
+            fused = np.concatenate([i.ravel() for i, _ in pending])
+            self._all_reduce(fused, fused)
+
+            offset = 0
+            for i, output in pending:
+                result = fused[offset:offset + i.size]
+                if isinstance(output, np.ndarray):
+                    output[...] = result.reshape(output.shape)
+                else:
+                    output[:] = result
+                offset += i.size
+
+        self._reduce_buf = {}
+        self._reduce_bytes = 0
+
+    def _all_reduce(self, input, output, algo="auto"):
+        input = np.asarray(input)
+        # distinct views are only the same buffer if they agree on every
+        # element, i.e. start, shape, strides and dtype
+        inplace = input is output or (
+            isinstance(output, np.ndarray)
+            and input.__array_interface__["data"][0] ==
+            output.__array_interface__["data"][0]
+            and input.shape == output.shape
+            and input.strides == output.strides
+            and input.dtype == output.dtype)
+
+        if algo == "auto" and input.nbytes > self._pipeline_threshold \
+                and isinstance(output, np.ndarray) \
+                and hasattr(self._role_maker, "iall_reduce_worker"):
+            self._pipelined_all_reduce(input, output, inplace)
+            return
+
+        # reducing into the input itself saves the copy of the result
+        if inplace and hasattr(self._role_maker, "all_reduce_worker_inplace"):
+            self._role_maker.all_reduce_worker_inplace(output)
+            return
+
+        if algo == "auto":
+            if input.nbytes < self._short_msg_bytes:
+                algo = "recursive_doubling"
+            else:
+                algo = "rs_ag"
+
+        # the role makers' plain all reduce is the latency optimal one, and
+        # the fallback for those without a reduce-scatter + allgather variant
+        if algo == "rs_ag" \
+                and hasattr(self._role_maker, "all_reduce_worker_rs_ag"):
+            self._role_maker.all_reduce_worker_rs_ag(input, output)
+        else:
+            self._role_maker.all_reduce_worker(input, output)
 
-    def barrier_worker(self):
+    def _pipelined_all_reduce(self, input, output, inplace=False):
         """
-        barrier between workers
+        reduce a long array as nbytes // 1MB chunks, clamped to 2..8, in
+        flight together so the phases of consecutive chunks overlap. Above
+        8MB this is always 8 equal chunks of nbytes / 8.
         """
-        self._role_maker.barrier_worker()
+        chunks = max(2, min(8, input.nbytes // (1024 * 1024)))
+        outputs = np.array_split(output, chunks)
+        if inplace:
+            inputs = outputs
+        else:
+            inputs = np.array_split(np.ascontiguousarray(input), chunks)
+        requests = [
+            self._role_maker.iall_reduce_worker(i, o)
+            for i, o in zip(inputs, outputs)
+        ]
+        for request in requests:
+            if request is not None:
+                request.Wait()
+
+    def barrier_worker(self, force=False):
+        """
+        barrier between workers, only every OPENKS_BARRIER_EVERY-th call
+        really synchronizes (default 1, i.e. every call). Pending fused
+        arrays of all_reduce_worker are flushed instead of a separate barrier.
+
+        Args:
+            force(bool): synchronize regardless of the counter, e.g. before
+                saving a checkpoint.
+        """
+        if not self._async_collective:
+            self._sync_barrier_worker(force)
+            return
+
+        # queued behind the pending reductions, waiting here lets other
+        # python threads run until the barrier is passed
+        self._collective_pool.submit(self._sync_barrier_worker, force).result()
+        self.wait_all_reduce()
+
+    def _sync_barrier_worker(self, force=False):
+        self._barrier_counter += 1
+        if not force and self._barrier_counter % self._barrier_every:
+            return
+        if self._reduce_buf:
+            # no worker leaves an all reduce before every worker entered it,
+            # so draining the fused arrays already synchronizes the workers
+            self._flush_all_reduce()
+            return
+        if self._cpu_group is not None:
+            import torch.distributed as dist
+            dist.barrier(group=self._cpu_group)
+        else:
+            self._role_maker.barrier_worker()
 
     @abc.abstractmethod
     def init_worker(self):
@@ -257,6 +492,8 @@ class BaseDistributedOptimizer(object):
     __metaclass__ = abc.ABCMeta
 
     def __init__(self, optimizer, strategy=None):
+        SGD = _lazy_import("SGD")
+        OptimizerWithMixedPrecision = _lazy_import("OptimizerWithMixedPrecision")
         if not isinstance(optimizer, SGD.__bases__) \
                 and not isinstance(optimizer, OptimizerWithMixedPrecision):
             raise TypeError("optimizer must be an instance of Optimizer")
@@ -4,10 +4,11 @@
 """Defination of Role Makers."""
 
 from __future__ import print_function
-import paddle.fluid as fluid
 import os
 import time
 
+import numpy as np
+
 __all__ = [
     'Role', 'RoleMakerBase', 'MPISymetricRoleMaker', 'UserDefinedRoleMaker',
     'UserDefinedCollectiveRoleMaker', 'PaddleCloudRoleMaker', 'GeneralRoleMaker', "Open_KS_read", "Open_KS_ImageNet",
@@ -253,6 +254,20 @@ class RoleMakerBase(object):
         """
         return self._server_endpoints
 
+    def get_process_group(self):
+        """
+        return the torch.distributed ProcessGroup this role maker communicates
+        through, None if it is not backed by torch.distributed. A role maker
+        returning a group must also implement get_worker_ranks().
+        """
+        return None
+
+    def get_worker_ranks(self):
+        """
+        return the torch.distributed ranks of all workers
+        """
+        raise NotImplementedError("Please implement this method in child class")
+
     def to_string(self):
         return "role: {}, current_id: {}, worker_endpoints: {}, server_endpoints: {}".format(
             self._role, self._current_id, self._worker_endpoints,
@@ -422,6 +437,82 @@ class MPISymetricRoleMaker(MPIRoleMaker):
             return
         self._all_reduce(input, output, mode)
 
+    def iall_reduce_worker(self, input, output, mode="sum"):
+        """
+        non-blocking all reduce between trainers if current role is TRAINER,
+        only support contiguous numpy.array of one dim.
+
+        Args:
+            input(numpy.array): array of one dim
+            output(numpy.array): array of one dim
+            mode(str): "sum" or "min" or "max"
+
+        Returns:
+            MPI.Request: call Wait() on it before reading output,
+                None if current role is not worker
+        """
+        if not self._role_is_generated:
+            self.generate_role()
+        if not self.is_worker():
+            print("warning: current role is not worker in iall_reduce_worker")
+            return None
+        if input is output:
+            input = self.MPI.IN_PLACE
+        return self._node_type_comm.Iallreduce(
+            input, output, op=self._get_mpi_op(mode))
+
+    def all_reduce_worker_inplace(self, buffer, mode="sum"):
+        """
+        all reduce between trainers if current role is TRAINER, writing the
+        result back into the input, only support numpy.array of one dim.
+
+        Args:
+            buffer(numpy.array): array of one dim
+            mode(str): "sum" or "min" or "max"
+        """
+        if not self._role_is_generated:
+            self.generate_role()
+        if not self.is_worker():
+            print("warning: current role is not worker in all_reduce_worker_inplace")
+            return
+        self._node_type_comm.Allreduce(
+            self.MPI.IN_PLACE, buffer, op=self._get_mpi_op(mode))
+
+    def all_reduce_worker_rs_ag(self, input, output, mode="sum"):
+        """
+        all reduce between trainers as a reduce-scatter followed by an
+        allgather, which moves 2(P-1)/P of the array per trainer and is
+        preferable for long arrays, only support array of one dim.
+
+        Args:
+            input(list/numpy.array): array of one dim
+            output(list/numpy.array): array of one dim
+            mode(str): "sum" or "min" or "max"
+        """
+        if not self._role_is_generated:
+            self.generate_role()
+        if not self.is_worker():
+            print("warning: current role is not worker in all_reduce_worker_rs_ag")
+            return
+        input = np.ascontiguousarray(input)
+        size = self._node_type_comm.Get_size()
+        rank = self._node_type_comm.Get_rank()
+        blocksize, remainder = divmod(len(input), size)
+        counts = [blocksize + (1 if r < remainder else 0) for r in range(size)]
+        displs = [sum(counts[:r]) for r in range(size)]
+
+        block = np.empty(counts[rank], dtype=input.dtype)
+        self._node_type_comm.Reduce_scatter(
+            input, block, recvcounts=counts, op=self._get_mpi_op(mode))
+        # gather straight into output when MPI can write to it
+        if isinstance(output, np.ndarray) and output.dtype == input.dtype \
+                and output.flags.c_contiguous:
+            self._node_type_comm.Allgatherv(block, [output, (counts, displs)])
+        else:
+            result = np.empty_like(input)
+            self._node_type_comm.Allgatherv(block, [result, (counts, displs)])
+            output[:] = result
+
     def barrier_worker(self):
         """
         barrier between trainers if current role is TRAINER
@@ -538,15 +629,19 @@ class MPISymetricRoleMaker(MPIRoleMaker):
         """
         if not self._role_is_generated:
             self.generate_role()
+        self._node_type_comm.Allreduce(input, output, op=self._get_mpi_op(mode))
+
+    def _get_mpi_op(self, mode):
+        """
+        map "sum", "max" or "min" to the MPI reduce operation
+        """
         if mode == "sum":
-            mode = self.MPI.SUM
+            return self.MPI.SUM
         elif mode == "max":
-            mode = self.MPI.MAX
+            return self.MPI.MAX
         elif mode == "min":
-            mode = self.MPI.MIN
-        else:
-            raise ValueError("unknown mode: %s" % mode)
-        self._node_type_comm.Allreduce(input, output, op=mode)
+            return self.MPI.MIN
+        raise ValueError("unknown mode: %s" % mode)
 
     def _barrier_worker(self):
         """
@@ -715,6 +810,7 @@ class GeneralRoleMaker(RoleMakerBase):
         generate role for general role maker
         """
         if not self._role_is_generated:
+            import paddle.fluid as fluid
             eplist = os.environ["PADDLE_PSERVERS_IP_PORT_LIST"].split(",")
             training_role = os.environ["TRAINING_ROLE"]
             worker_endpoints = os.environ["PADDLE_TRAINER_ENDPOINTS"].split(",")
@@ -155,6 +155,7 @@ class CPUDistributedAlgorithm(BaseDistributedAlgorithm):
         if isinstance(self._role_maker, MPISymetricRoleMaker):
             self._role_maker._finalize()
         self._executor.close()
+        self._executor = None
 
     def distributed_optimizer(self, optimizer, strategy=None):
         """
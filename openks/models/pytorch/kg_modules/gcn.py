@@ -5,17 +5,107 @@
 # Create Time: 2019/12/13 15:38
 # TODO:
 
+import contextlib
+
 import dgl
 import dgl.function as fn
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 # from dgl.model_zoo.chem.gnn import GCNLayer
-from dgl.nn.pytorch import AvgPooling, Set2Set
+from dgl.nn.pytorch import Set2Set
 
-from dgl.nn.pytorch import GraphConv, GATConv
+from dgl.nn.pytorch import GATConv
 from ...model import TorchModel
 
+def _graph_cache(g):
+    """Tensors derived from the structure of g, kept on g and dropped when
+    its number of nodes or edges changes. Delete g._gcn_cache after edits
+    that keep both counts.
+    """
+    size = (g.number_of_nodes(), g.number_of_edges())
+    cache = getattr(g, "_gcn_cache", None)
+    if cache is None or cache["size"] != size:
+        cache = g._gcn_cache = {"size": size}
+    return cache
+
+def gcn_adj(g, norm, device, dtype):
+    """Coalesced (dst, src) COO adjacency of g and its transpose, cached per
+    norm, device and dtype. With norm="both" every edge u -> v is weighted by
+    the symmetric GCN normalization 1 / sqrt(d_out(u) * d_in(v)).
+    """
+    cache = _graph_cache(g)
+    key = ("adj", norm, device, dtype)
+    if key not in cache:
+        src, dst = g.all_edges(order="eid")
+        src, dst = src.to(device), dst.to(device)
+        if norm == "both":
+            out_norm = g.out_degrees().to(device).float().clamp(min=1).pow_(-0.5)
+            in_norm = g.in_degrees().to(device).float().clamp(min=1).pow_(-0.5)
+            values = out_norm[src] * in_norm[dst]
+        else:
+            values = torch.ones(src.size(0), device=device)
+        values = values.to(dtype)
+        num_nodes = g.number_of_nodes()
+        size = (num_nodes, num_nodes)
+        cache[key] = (
+            torch.sparse_coo_tensor(torch.stack([dst, src]), values, size).coalesce(),
+            torch.sparse_coo_tensor(torch.stack([src, dst]), values, size).coalesce(),
+        )
+    return cache[key]
+
+class _SpMM(torch.autograd.Function):
+    """adj @ feats, back-propagated as adj^T @ grad with the cached
+    transpose, so neither direction coalesces the adjacency again.
+    """
+    @staticmethod
+    def forward(ctx, adj, adj_t, feats):
+        ctx.adj_t = adj_t
+        return torch.sparse.mm(adj, feats)
+
+    @staticmethod
+    def backward(ctx, grad):
+        return None, None, torch.sparse.mm(ctx.adj_t, grad)
+
+class SpMMGraphConv(nn.Module):
+    """Graph convolution computing the propagation as a single sparse-dense
+    matrix product with the adjacency from gcn_adj. Parameters match those
+    of dgl's GraphConv with norm="none", so its checkpoints can be loaded.
+    Parameters
+    ----------
+    in_feats : int
+        Number of input features
+    out_feats : int
+        Number of output features
+    activation : activation function or None
+        Default to be None
+    """
+    def __init__(self, in_feats, out_feats, activation=None):
+        super(SpMMGraphConv, self).__init__()
+        self._in_feats = in_feats
+        self._out_feats = out_feats
+        self.weight = nn.Parameter(torch.Tensor(in_feats, out_feats))
+        self.bias = nn.Parameter(torch.Tensor(out_feats))
+        self.activation = activation
+        nn.init.xavier_uniform_(self.weight)
+        nn.init.zeros_(self.bias)
+
+    def forward(self, g, feats, adj=None):
+        """Sum the neighbour features along in-edges, weighted by the
+        (adj, adj_t) pair from gcn_adj if given, then apply weight, bias
+        and activation.
+        """
+        if adj is None:
+            adj = gcn_adj(g, "none", feats.device, feats.dtype)
+        if self._in_feats > self._out_feats:
+            rst = _SpMM.apply(adj[0], adj[1], torch.matmul(feats, self.weight))
+        else:
+            rst = torch.matmul(_SpMM.apply(adj[0], adj[1], feats), self.weight)
+        rst = rst + self.bias.to(rst.dtype)
+        if self.activation is not None:
+            rst = self.activation(rst)
+        return rst
+
 class GCNLayer(nn.Module):
     """Single layer GCN for updating node features
     Parameters
@@ -27,32 +117,38 @@ class GCNLayer(nn.Module):
     activation : activation function
         Default to be ReLU
     residual : bool
-        Whether to use residual connection, default to be True
+        Whether to use residual connection, default to be True. The
+        connection is an identity when in_feats equals out_feats
     batchnorm : bool
         Whether to use batch normalization on the output,
         default to be True
+    bn_affine : bool
+        Whether batch normalization has a learnable scale and shift,
+        default to be True
     dropout : float
         The probability for dropout. Default to be 0., i.e. no
         dropout is performed.
     """
     def __init__(self, in_feats, out_feats, activation=F.relu,
-                 residual=True, batchnorm=True, dropout=0.):
+                 residual=True, batchnorm=True, bn_affine=True, dropout=0.):
         super(GCNLayer, self).__init__()
 
         self.activation = activation
-        self.graph_conv = GraphConv(in_feats=in_feats, out_feats=out_feats,
-                                    norm="none", activation=activation)
-        self.dropout = nn.Dropout(dropout)
+        self.graph_conv = SpMMGraphConv(in_feats=in_feats, out_feats=out_feats,
+                                        activation=activation)
+        self.dropout = dropout
 
         self.residual = residual
-        if residual:
+        if residual and in_feats == out_feats:
+            self.res_connection = nn.Identity()
+        elif residual:
             self.res_connection = nn.Linear(in_feats, out_feats)
 
         self.bn = batchnorm
         if batchnorm:
-            self.bn_layer = nn.BatchNorm1d(out_feats)
+            self.bn_layer = nn.BatchNorm1d(out_feats, affine=bn_affine)
 
-    def forward(self, g, feats):
+    def forward(self, g, feats, adj=None):
         """Update atom representations
         Parameters
         ----------
@@ -61,18 +157,32 @@ class GCNLayer(nn.Module):
         feats : FloatTensor of shape (N, M1)
             * N is the total number of atoms in the batched graph
             * M1 is the input atom feature size, must match in_feats in initialization
+        adj : pair of sparse tensors or None
+            Adjacency and its transpose from gcn_adj, e.g. with the GCN
+            normalization. Default to be None, i.e. plain sum
         Returns
         -------
         new_feats : FloatTensor of shape (N, M2)
             * M2 is the output atom feature size, must match out_feats in initialization
         """
-        new_feats = self.graph_conv(g, feats)
+        new_feats = self.graph_conv(g, feats, adj=adj)
         if self.residual:
-            res_feats = self.activation(self.res_connection(feats))
+            res_feats = self.res_connection(feats)
+            if self.activation is not None:
+                res_feats = self.activation(res_feats)
             new_feats = new_feats + res_feats
-        new_feats = self.dropout(new_feats)
+            if self.dropout > 0.:
+                # the sum is a fresh tensor, so dropout may overwrite it
+                new_feats = F.dropout(new_feats, p=self.dropout,
+                                      training=self.training, inplace=True)
+        elif self.dropout > 0.:
+            # not in place, the graph conv output may be saved by its activation
+            new_feats = F.dropout(new_feats, p=self.dropout,
+                                  training=self.training)
 
-        if self.bn:
+        # batch statistics of a single node are meaningless (and rejected
+        # by BatchNorm1d), running statistics are still used in eval
+        if self.bn and (new_feats.size(0) > 1 or not self.training):
             new_feats = self.bn_layer(new_feats)
 
         return new_feats
@@ -138,6 +248,28 @@ class GATLayer(nn.Module):
 
         return new_feats
 
+def avg_readout(g, feats):
+    """Mean of the node features of every graph in the batch, computed as one
+    index_add_ over the graph id of each node, cached with _graph_cache.
+    """
+    cache = _graph_cache(g)
+    key = ("readout", feats.device)
+    if key not in cache:
+        # a list property of BatchedDGLGraph in dgl 0.4, a method later on,
+        # and missing on unbatched graphs in dgl 0.4
+        batch_num_nodes = getattr(g, "batch_num_nodes", None)
+        if batch_num_nodes is None:
+            batch_num_nodes = [g.number_of_nodes()]
+        elif callable(batch_num_nodes):
+            batch_num_nodes = batch_num_nodes()
+        batch_num_nodes = torch.as_tensor(batch_num_nodes, device=feats.device)
+        graph_ids = torch.arange(len(batch_num_nodes), device=feats.device)
+        cache[key] = (torch.repeat_interleave(graph_ids, batch_num_nodes),
+                      batch_num_nodes.clamp(min=1).unsqueeze(1))
+    seg, counts = cache[key]
+    out = feats.new_zeros(counts.size(0), feats.size(1)).index_add_(0, seg, feats)
+    return out.div_(counts.to(out.dtype))
+
 @TorchModel.register("UnsupervisedGCN", "PyTorch")
 class UnsupervisedGCN(nn.Module):
     def __init__(
@@ -148,23 +280,40 @@ class UnsupervisedGCN(nn.Module):
         layernorm: bool = False,
         set2set_lstm_layer: int = 3,
         set2set_iter: int = 6,
+        norm: str = "none",
+        dtype: torch.dtype = torch.float32,
+        residual: bool = False,
     ):
         super(UnsupervisedGCN, self).__init__()
+        if norm not in ("none", "both"):
+            raise NotImplementedError
+        self.norm = norm
+        # the graph layers may run in bfloat16, readout stays in float32
+        if dtype not in (torch.float32, torch.bfloat16):
+            raise NotImplementedError
+        if dtype == torch.bfloat16 and not hasattr(torch, "autocast"):
+            raise RuntimeError("dtype=torch.bfloat16 needs torch.autocast, "
+                               "available from PyTorch 1.10")
+        self.dtype = dtype
         self.layers = nn.ModuleList(
             [
                 GCNLayer(
                     in_feats=hidden_size,
                     out_feats=hidden_size,
                     activation=F.relu if i + 1 < num_layer else None,
-                    residual=False,
+                    # hidden_size -> hidden_size, i.e. an identity residual
+                    # shared by all layers without any parameters
+                    residual=residual,
                     batchnorm=False,
                     dropout=0.0,
                 )
                 for i in range(num_layer)
             ]
         )
+        self._is_set2set = readout == "set2set"
+        self._is_root = readout == "root"
         if readout == "avg":
-            self.readout = AvgPooling()
+            self.readout = avg_readout
         elif readout == "set2set":
             self.readout = Set2Set(
                 hidden_size, n_iters=set2set_iter, n_layers=set2set_lstm_layer
@@ -172,7 +321,7 @@ class UnsupervisedGCN(nn.Module):
             self.linear = nn.Linear(2 * hidden_size, hidden_size)
         elif readout == "root":
             # HACK: process outside the model part
-            self.readout = lambda _, x: x
+            self.readout = None
         else:
             raise NotImplementedError
         self.layernorm = layernorm
@@ -180,11 +329,21 @@ class UnsupervisedGCN(nn.Module):
             self.ln = nn.LayerNorm(hidden_size, elementwise_affine=False)
             # self.ln = nn.BatchNorm1d(hidden_size, affine=False)
 
-    def forward(self, g, feats, efeats=None):
-        for layer in self.layers:
-            feats = layer(g, feats)
-        feats = self.readout(g, feats)
-        if isinstance(self.readout, Set2Set):
+    def forward(self, g, feats):
+        adj = gcn_adj(g, self.norm, feats.device, self.dtype)
+        if self.dtype == torch.float32:
+            context = contextlib.nullcontext()
+        else:
+            context = torch.autocast(device_type=feats.device.type,
+                                     dtype=self.dtype)
+        with context:
+            feats = feats.to(self.dtype)
+            for layer in self.layers:
+                feats = layer(g, feats, adj)
+        feats = feats.float()
+        if not self._is_root:
+            feats = self.readout(g, feats)
+        if self._is_set2set:
             feats = self.linear(feats)
         if self.layernorm:
             feats = self.ln(feats)
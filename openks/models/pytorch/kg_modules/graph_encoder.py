@@ -195,6 +195,10 @@ class GraphEncoder(nn.Module):
         e_feat = None
         if self.gnn_model == "gin":
             x, all_outputs = self.gnn(g, n_feat, e_feat)
+        elif self.gnn_model == "gcn":
+            x, all_outputs = self.gnn(g, n_feat), None
+            x = self.set2set(g, x)
+            x = self.lin_readout(x)
         else:
             x, all_outputs = self.gnn(g, n_feat, e_feat), None
             x = self.set2set(g, x)